@@ -1,36 +1,76 @@
 from flask import Flask, request, send_file, jsonify
+from flask.json.provider import DefaultJSONProvider
 from notion_client import Client as NotionClient
 import requests
+import httpx
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 import io
-import tempfile
-import openpyxl
-from openpyxl.drawing.image import Image as OpenpyxlImage
-from openpyxl.styles import Alignment
+import hashlib
+import zipfile
+from xml.sax.saxutils import escape as xml_escape
+from openpyxl.utils.protection import hash_password
 import smtplib
+import mimetypes
 from email.message import EmailMessage
+from email.utils import formatdate, make_msgid
 from PIL import Image
+import numpy as np
 import time
+import queue
+import threading
+import functools
 from collections import OrderedDict
-from datetime import datetime, timezone
-from dateutil import parser
-import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import atexit
 from apscheduler.schedulers.background import BackgroundScheduler
 import re
+import sqlite3
+import textwrap
+from jinja2 import Environment
+import orjson
 
-# Set up logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("brandid_processor.log"),
-        logging.StreamHandler()
-    ]
-)
+# Set up logging: callers only enqueue records, a listener thread does the
+# file and console writes off the request/worker threads
+_LOG_FORMATTER = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+_LOG_HANDLERS = [
+    logging.FileHandler("brandid_processor.log"),
+    logging.StreamHandler()
+]
+for _handler in _LOG_HANDLERS:
+    _handler.setFormatter(_LOG_FORMATTER)
+
+_LOG_QUEUE = queue.Queue(-1)
+_queue_handler = QueueHandler(_LOG_QUEUE)
+_queue_handler.setFormatter(logging.Formatter('%(message)s'))  # Full format is applied by the listener
+LOG_LISTENER = QueueListener(_LOG_QUEUE, *_LOG_HANDLERS)
+LOG_LISTENER.start()
+atexit.register(LOG_LISTENER.stop)  # Drain queued records on shutdown
+
+logging.basicConfig(level=logging.INFO, handlers=[_queue_handler])
 logger = logging.getLogger("BrandIDProcessor")
 
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson for faster request/response (de)serialization"""
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
+
+class OrjsonNotionClient(NotionClient):
+    """Notion client that decodes successful responses with orjson instead of stdlib json"""
+    def _parse_response(self, response):
+        if response.is_success:
+            return orjson.loads(response.content)
+        return super()._parse_response(response)  # Raises the SDK's typed errors
 
 # === ENVIRONMENT VARIABLES ===
 NOTION_TOKEN = os.getenv("NOTION_TOKEN")
@@ -38,13 +78,144 @@ DATABASE_ID = os.getenv("NOTION_DATABASE_ID")
 TEMPLATE_PATH = "invoice-watermarked.xlsx"
 SCHEDULER_INTERVAL = int(os.getenv("SCHEDULER_INTERVAL", "60"))  # Default to 60 minutes
 
-# Initialize Notion client
-notion = NotionClient(auth=NOTION_TOKEN)
+# SMTP settings are resolved once at import; the environment doesn't change at runtime
+SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
+SMTP_USER = os.getenv("SMTP_USER")
+SMTP_PASS = os.getenv("SMTP_PASS")
+SENDER_NAME = os.getenv("SENDER_NAME", "Invoice Generator")
+SMTP_DOMAIN = SMTP_USER.split("@")[-1] if SMTP_USER else None
+
+# Attachment (maintype, subtype) by lowercased suffix; anything else falls back to mimetypes
+_MIME = {
+    ".xlsx": ("application", "vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    ".pdf": ("application", "pdf"),
+}
+
+# Initialize Notion client on an explicit keep-alive pool shared by every worker thread
+NOTION_HTTP_CLIENT = httpx.Client(
+    limits=httpx.Limits(max_connections=10, max_keepalive_connections=10, keepalive_expiry=60)
+)
+notion = OrjsonNotionClient(auth=NOTION_TOKEN, client=NOTION_HTTP_CLIENT)
+
+# Processed events persisted in SQLite (event_id -> timestamp, processed) so
+# claims survive restarts and are shared by every worker process. Entries
+# expire after EVENT_TTL seconds and are swept at the start of every run
+EVENTS_DB_PATH = os.getenv("EVENTS_DB_PATH", "idempotency.db")
+EVENT_TTL = 3600  # seconds
+EVENT_CLAIM_TIMEOUT = 600  # seconds before an unfinished claim (e.g. from a crash) can be retaken
+EVENT_SWEEP_INTERVAL = 5  # minutes
+HEALTH_EVENTS_LIMIT = 100  # most recent events listed by /health
+_EVENTS_LOCK = threading.Lock()
+EVENTS_DB = sqlite3.connect(EVENTS_DB_PATH, timeout=5, isolation_level=None, check_same_thread=False)
+EVENTS_DB.execute("PRAGMA journal_mode=WAL")
+EVENTS_DB.execute("PRAGMA synchronous=NORMAL")
+EVENTS_DB.execute("CREATE TABLE IF NOT EXISTS events (id TEXT PRIMARY KEY, processed INTEGER NOT NULL, ts REAL NOT NULL)")
+
+# Background-removed logo PNGs keyed by a hash of the downloaded bytes, so a
+# brand resubmitting the same logo skips the PIL/NumPy pass
+MAX_LOGO_CACHE_SIZE = 64
+
+# On-disk logo cache that survives restarts: downloaded logos keyed by a stable
+# form of their URL, and processed PNGs keyed by content hash
+LOGO_CACHE_DIR = os.getenv("LOGO_CACHE_DIR", ".logo_cache")
+LOGO_CACHE_TTL = 7 * 24 * 3600  # seconds
+LOGO_CACHE_SWEEP_INTERVAL = 60  # minutes
+
+# Pending "Email Sent" updates, flushed in batches instead of one call per record.
+# Items are (page_id, properties, queued_at, attempts, retry_at); failed writes back
+# off exponentially and are dropped after NOTION_UPDATE_MAX_ATTEMPTS
+NOTION_UPDATE_QUEUE = queue.Queue()
+NOTION_UPDATE_WORKERS = 4
+NOTION_FLUSH_INTERVAL = 5  # seconds
+NOTION_UPDATE_MAX_ATTEMPTS = 5
+NOTION_UPDATE_BACKOFF = 10  # seconds before the first retry, doubled after each failure
+# Pages with a queued write that hasn't landed yet (or was dropped), so a run can
+# tell whether its own writes succeeded whichever flush sent them
+_UNCONFIRMED_UPDATES = set()
+_UNCONFIRMED_UPDATES_LOCK = threading.Lock()
+
+# In-memory TTL cache for Notion page/block reads:
+# (call, page or block id, page_size) -> (expires_at, value)
+# Bounded, oldest entries are evicted first. Database queries are not cached: each
+# run filters on a new last_edited_time, so a cached query would never be hit again
+NOTION_CACHE = OrderedDict()
+MAX_NOTION_CACHE_SIZE = 1000
+NOTION_PAGE_TTL = 600  # seconds, page and block reads
+_NOTION_CACHE_LOCK = threading.Lock()
+
+# Keep-alive session for logo downloads so repeat fetches skip the TCP/TLS handshake
+HTTP_TIMEOUT = (5, 15)  # seconds: connect, read
+HTTP_CHUNK_SIZE = 64 * 1024
+MAX_LOGO_BYTES = 10 * 1024 * 1024
+MAX_LOGO_PIXELS = 4096 * 4096  # decoded size limit; a small compressed file can expand hugely
+BACKGROUND_TOLERANCE = 20  # per-channel distance from the corner colour treated as background
+# Bump when process_logo's output changes so cached PNGs from the old pipeline aren't reused
+LOGO_PROCESS_VERSION = 2
+HTTP_SESSION = requests.Session()
+HTTP_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=20,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504)),
+))
+
+# Records processed concurrently per scheduler tick; Notion calls are capped
+# separately to stay under its rate limit (~3 requests/second)
+RECORD_WORKERS = 6
+NOTION_MAX_CONCURRENCY = 4
+NOTION_SEMAPHORE = threading.BoundedSemaphore(NOTION_MAX_CONCURRENCY)
+NOTION_RATE_LIMIT = 3  # requests per second
 
-# Simple in-memory cache of processed events
-# Using OrderedDict to limit memory usage (keeps only most recent 100 events)
-PROCESSED_EVENTS = OrderedDict()
-MAX_CACHE_SIZE = 100
+# Each run only queries pages edited since the last fully successful run.
+# Notion rounds last_edited_time down to the minute, so look back a little further
+LAST_TICK_PATH = os.getenv("LAST_TICK_PATH", ".last_tick")
+LAST_TICK_OVERLAP = 120  # seconds
+RECORD_IN_FLIGHT = "in_flight"  # _process_record outcome when another run holds the claim
+
+# Manual runs are handed off so /run-processor can return right away; one at a time
+RUN_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+_manual_run = None
+_MANUAL_RUN_LOCK = threading.Lock()
+
+def claim_event(event_id):
+    """Atomically claim an event; returns False if it is already in flight or processed"""
+    now = time.time()
+    with _EVENTS_LOCK:
+        cursor = EVENTS_DB.execute(
+            "INSERT INTO events (id, processed, ts) VALUES (?, 0, ?) "
+            "ON CONFLICT(id) DO UPDATE SET ts = excluded.ts WHERE processed = 0 AND ts < ?",
+            (event_id, now, now - EVENT_CLAIM_TIMEOUT)
+        )
+        return cursor.rowcount == 1
+
+def mark_event_processed(event_id):
+    """Record a claimed event as successfully processed"""
+    with _EVENTS_LOCK:
+        EVENTS_DB.execute("INSERT OR REPLACE INTO events (id, processed, ts) VALUES (?, 1, ?)", (event_id, time.time()))
+
+def release_event(event_id):
+    """Give up a claim so the event can be retried"""
+    with _EVENTS_LOCK:
+        EVENTS_DB.execute("DELETE FROM events WHERE id = ?", (event_id,))
+
+def sweep_processed_events():
+    """Drop idempotency entries older than EVENT_TTL"""
+    cutoff = time.time() - EVENT_TTL
+    with _EVENTS_LOCK:
+        EVENTS_DB.execute("DELETE FROM events WHERE ts < ?", (cutoff,))
+
+def count_processed_events():
+    """Number of entries in the idempotency cache"""
+    with _EVENTS_LOCK:
+        return EVENTS_DB.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+
+def snapshot_processed_events(limit=HEALTH_EVENTS_LIMIT):
+    """Return the most recent idempotency entries: event_id -> (timestamp, processed)"""
+    with _EVENTS_LOCK:
+        rows = EVENTS_DB.execute(
+            "SELECT id, ts, processed FROM events ORDER BY ts DESC LIMIT ?", (limit,)
+        ).fetchall()
+    return {event_id: (timestamp, bool(processed)) for event_id, timestamp, processed in rows}
 
 def get_property_value(properties, name, type_name):
     """Extract values from Notion property objects"""
@@ -71,7 +242,7 @@ def get_property_value(properties, name, type_name):
     return ""
 
 # Define a list of words to ignore in the brand ID generation
-IGNORE_WORDS = {
+IGNORE_WORDS = frozenset({
     # Articles
     'a', 'an', 'the',
     
@@ -102,8 +273,19 @@ IGNORE_WORDS = {
     
     # Common suffixes
     'ing', 'ed', 'ly'
-}
+})
+
+# Lowercase→uppercase boundary (CamelCase) and runs of non-alphanumerics
+_CAMEL_SPLIT = re.compile(r'(?<=[a-z])(?=[A-Z])')
+_WORD_SPLIT = re.compile(r'[^a-zA-Z0-9]+')
+
+# Matches any letter that isn't a vowel (words are already split to ASCII alphanumerics)
+_CONSONANT_RE = re.compile(r'[^aeiouAEIOU\W\d_]')
+
+# Letters used, in rotation, to pad a short name code to 4 characters
+_PADDING = ('X', 'Y', 'Z')
 
+@functools.lru_cache(maxsize=4096)
 def generate_brand_id(business_name, email=None):
     """Generate a unique Brand ID following these specific rules:
     
@@ -130,15 +312,15 @@ def generate_brand_id(business_name, email=None):
         email = "example@example.com"
     
     # STEP 1: Split CamelCase by inserting spaces at lowercase→uppercase boundaries
-    business_name_with_spaces = re.sub(r'(?<=[a-z])(?=[A-Z])', ' ', business_name)
-    logger.info(f"After CamelCase splitting: '{business_name_with_spaces}'")
+    business_name_with_spaces = _CAMEL_SPLIT.sub(' ', business_name)
+    logger.debug("After CamelCase splitting: %r", business_name_with_spaces)
     
     # STEP 2: Split into words by spaces and other separators
-    all_words = [w for w in re.split(r'[^a-zA-Z0-9]+', business_name_with_spaces) if w]
+    all_words = [w for w in _WORD_SPLIT.split(business_name_with_spaces) if w]
     if not all_words:
         all_words = ["Unknown"]
     
-    logger.info(f"All words after splitting: {all_words}")
+    logger.debug("All words after splitting: %s", all_words)
     
     # STEP 3: Filter out ignore words (case insensitive)
     important_words = []
@@ -150,10 +332,7 @@ def generate_brand_id(business_name, email=None):
     if not important_words:
         important_words = all_words
     
-    logger.info(f"Important words after filtering: {important_words}")
-    
-    # Define vowels for consonant detection
-    vowels = set('aeiouAEIOU')
+    logger.debug("Important words after filtering: %s", important_words)
     
     # STEP 4-6: Generate the brand ID from important words
     name_part = ""
@@ -167,11 +346,11 @@ def generate_brand_id(business_name, email=None):
         
         # STEP 5: Find first consonant from first important word
         first_consonant = None
-        if len(important_words[0]) > 1:
-            for ch in important_words[0][1:]:
-                if ch.isalpha() and ch.upper() not in vowels and ch.upper() not in used_letters:
-                    first_consonant = ch.upper()
-                    break
+        for match in _CONSONANT_RE.finditer(important_words[0], 1):
+            ch = match.group().upper()
+            if ch not in used_letters:
+                first_consonant = ch
+                break
         
         if first_consonant:
             name_part += first_consonant
@@ -192,20 +371,17 @@ def generate_brand_id(business_name, email=None):
         for word in important_words[1:]:  # Skip the first word, we already used its consonant
             if len(name_part) >= 4:
                 break
-            if len(word) > 1:
-                for ch in word[1:]:
-                    if len(name_part) >= 4:
-                        break
-                    if ch.isalpha() and ch.upper() not in vowels and ch.upper() not in used_letters:
-                        name_part += ch.upper()
-                        used_letters.add(ch.upper())
-                        break
+            for match in _CONSONANT_RE.finditer(word, 1):
+                ch = match.group().upper()
+                if ch not in used_letters:
+                    name_part += ch
+                    used_letters.add(ch)
+                    break
     
     # If we still need more characters, add padding
-    padding = ['X', 'Y', 'Z']
     i = 0
     while len(name_part) < 4:
-        pad = padding[i % 3]
+        pad = _PADDING[i % 3]
         if pad not in used_letters:
             name_part += pad
             used_letters.add(pad)
@@ -214,10 +390,13 @@ def generate_brand_id(business_name, email=None):
     # Ensure exactly 4 characters
     name_part = name_part[:4]
     
-    logger.info(f"Final name part: {name_part}")
+    logger.debug("Final name part: %s", name_part)
     
     # Build the email part
-    email_ascii_sum = sum(ord(c) for c in email)
+    if email.isascii():
+        email_ascii_sum = sum(email.encode('ascii'))
+    else:
+        email_ascii_sum = sum(map(ord, email))
     email_part = str(email_ascii_sum)[-4:].zfill(4)
     
     # Construct and return
@@ -227,56 +406,139 @@ def generate_brand_id(business_name, email=None):
 
 
 # === UTILITIES ===
-def send_email(recipient_email, subject, body, attachment_paths, business_name='', brand_id=''):
-    """Send email with attachments and formatted HTML body"""
-    smtp_server = os.getenv('SMTP_SERVER', 'smtp.gmail.com')
-    smtp_port = int(os.getenv('SMTP_PORT', 587))
-    smtp_user = os.getenv('SMTP_USER')
-    smtp_pass = os.getenv('SMTP_PASS')
-    sender_name = os.getenv('SENDER_NAME', 'Invoice Generator')
-
-    # Create a more sophisticated email
-    msg = EmailMessage()
+class LRUCache:
+    """Bounded, thread-safe LRU mapping"""
     
-    # Better subject line with personalization
-    personalized_subject = f"{business_name} - {subject}" if business_name else subject
-    msg['Subject'] = personalized_subject
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
     
-    # Add proper From header with sender name
-    msg['From'] = f'"{sender_name}" <{smtp_user}>'
-    msg['To'] = recipient_email
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                return default
+            self._data.move_to_end(key)
+            return self._data[key]
     
-    # Add more headers to improve deliverability
-    # Add a unique Message-ID
-    domain = smtp_user.split('@')[-1]
-    msg['Message-ID'] = f"<{uuid.uuid4()}@{domain}>"
-    
-    # Add Date header
-    msg['Date'] = datetime.now().strftime("%a, %d %b %Y %H:%M:%S %z")
-    
-    # Add X-Mailer header 
-    msg['X-Mailer'] = 'InvoiceCustomizer Service'
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if len(self._data) > self.capacity:
+                self._data.popitem(last=False)
+
+PROCESSED_LOGO_CACHE = LRUCache(MAX_LOGO_CACHE_SIZE)
+
+class SMTPConnectionPool:
+    """Keeps one authenticated SMTP connection open and reuses it across sends"""
+
+    def __init__(self, server, port, user, password, max_messages=100, idle_check=30):
+        self.server = server
+        self.port = port
+        self.user = user
+        self.password = password
+        self.max_messages = max_messages  # Rotate the connection after this many sends
+        self.idle_check = idle_check  # Seconds idle before we NOOP to check the connection
+        self._conn = None
+        self._sent = 0
+        self._last_used = 0
+        self._lock = threading.RLock()
+
+    def _connect(self):
+        conn = smtplib.SMTP(self.server, self.port, timeout=30)
+        conn.starttls()
+        conn.login(self.user, self.password)
+        self._conn = conn
+        self._sent = 0
+        self._last_used = time.time()
+        return conn
+
+    def _is_alive(self):
+        try:
+            return self._conn.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            # A socket reset by the server raises ConnectionResetError/BrokenPipeError
+            return False
+
+    def get(self):
+        """Return a live connection, reconnecting if it was dropped or is due for rotation"""
+        with self._lock:
+            if self._conn is None or self._sent >= self.max_messages:
+                return self.reconnect()
+            if time.time() - self._last_used > self.idle_check and not self._is_alive():
+                return self.reconnect()
+            return self._conn
+
+    def reconnect(self):
+        with self._lock:
+            self.close()
+            return self._connect()
+
+    def send(self, msg):
+        """Send a message over the pooled connection, reconnecting once if it was dropped"""
+        with self._lock:
+            try:
+                self.get().send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                self.reconnect().send_message(msg)
+            self._sent += 1
+            self._last_used = time.time()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                try:
+                    self._conn.quit()
+                except Exception:
+                    pass
+                self._conn = None
+
+SMTP_POOL = SMTPConnectionPool(SMTP_SERVER, SMTP_PORT, SMTP_USER, SMTP_PASS)
+atexit.register(SMTP_POOL.close)  # QUIT the pooled session on shutdown
+
+class TokenBucket:
+    """Thread-safe token bucket; acquire() blocks until a token is available"""
     
-    # Add a List-Unsubscribe header (helps with spam prevention)
-    msg['List-Unsubscribe'] = f'<mailto:{smtp_user}?subject=Unsubscribe>'
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
     
-    # Create personalized HTML content
-    html_content = f"""
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+NOTION_RATE_LIMITER = TokenBucket(NOTION_RATE_LIMIT, NOTION_RATE_LIMIT)
+
+# HTML email body, compiled once at import and rendered per send; autoescape
+# keeps customer-supplied names from injecting markup
+_HTML_TEMPLATE = Environment(autoescape=True, keep_trailing_newline=True).from_string(textwrap.dedent("""\
     <!DOCTYPE html>
     <html>
     <head>
         <meta charset="utf-8">
         <meta name="viewport" content="width=device-width, initial-scale=1">
-        <title>{personalized_subject}</title>
+        <title>{{ subject }}</title>
         <style>
-            body {{ font-family: Arial, sans-serif; line-height: 1.6; color: #333; padding: 20px; }}
-            .container {{ max-width: 600px; margin: 0 auto; }}
-            .header {{ background-color: #f8f9fa; padding: 15px; border-bottom: 1px solid #e9ecef; }}
-            .content {{ padding: 20px 0; }}
-            .footer {{ font-size: 12px; color: #6c757d; padding-top: 20px; border-top: 1px solid #e9ecef; }}
-            .brand-id-box {{ background-color: #f0f8ff; border: 1px solid #b0c4de; padding: 15px; border-radius: 5px; margin: 20px 0; text-align: center; }}
-            .brand-id {{ font-size: 24px; font-weight: bold; letter-spacing: 1px; color: #0056b3; }}
-            .instructions {{ background-color: #fffaf0; border-left: 4px solid #ffa500; padding: 10px; margin: 15px 0; }}
+            body { font-family: Arial, sans-serif; line-height: 1.6; color: #333; padding: 20px; }
+            .container { max-width: 600px; margin: 0 auto; }
+            .header { background-color: #f8f9fa; padding: 15px; border-bottom: 1px solid #e9ecef; }
+            .content { padding: 20px 0; }
+            .footer { font-size: 12px; color: #6c757d; padding-top: 20px; border-top: 1px solid #e9ecef; }
+            .brand-id-box { background-color: #f0f8ff; border: 1px solid #b0c4de; padding: 15px; border-radius: 5px; margin: 20px 0; text-align: center; }
+            .brand-id { font-size: 24px; font-weight: bold; letter-spacing: 1px; color: #0056b3; }
+            .instructions { background-color: #fffaf0; border-left: 4px solid #ffa500; padding: 10px; margin: 15px 0; }
         </style>
     </head>
     <body>
@@ -285,28 +547,28 @@ def send_email(recipient_email, subject, body, attachment_paths, business_name='
                 <h2>Your Custom Invoice Template & Brand ID</h2>
             </div>
             <div class="content">
-                <p>Hello{' ' + business_name if business_name else ''},</p>
-                
+                <p>Hello{% if business_name %} {{ business_name }}{% endif %},</p>
+
                 <p>Thank you for using our Invoice Generator service! Your custom Excel invoice template is now ready.</p>
-                
+
                 <div class="brand-id-box">
                     <p>Your unique Brand ID is:</p>
-                    <p class="brand-id">{brand_id}</p>
+                    <p class="brand-id">{{ brand_id }}</p>
                 </div>
-                
+
                 <div class="instructions">
                     <p><strong>Important:</strong> Save this Brand ID for future purchases. When you buy additional templates on Etsy, include this Brand ID in your order notes to have them automatically customized with your business information.</p>
                 </div>
-                
+
                 <p>We've attached the spreadsheet to this email. You can fill in the item details, and the calculations will be performed automatically.</p>
-                
+
                 <p>This customized invoice includes:</p>
                 <ul>
                     <li>Your business information and logo</li>
                     <li>Customized tax rate</li>
                     <li>Protected formulas to prevent accidental changes</li>
                 </ul>
-                
+
                 <p>If you have any questions or need assistance, please reply to this email.</p>
             </div>
             <div class="footer">
@@ -316,24 +578,56 @@ def send_email(recipient_email, subject, body, attachment_paths, business_name='
         </div>
     </body>
     </html>
-    """
+    """))
+
+def attachment_mime_type(file_name):
+    """Return (maintype, subtype) for an attachment, matching the suffix case-insensitively"""
+    mime = _MIME.get(os.path.splitext(file_name)[1].lower())
+    if mime is None:
+        mime_type = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+        mime = tuple(mime_type.split('/', 1))
+    return mime
+
+def send_email(recipient_email, subject, body, attachments, business_name='', brand_id=''):
+    """Send email with in-memory (filename, bytes) attachments and formatted HTML body"""
+    # Create a more sophisticated email
+    msg = EmailMessage()
+    
+    # Better subject line with personalization
+    personalized_subject = f"{business_name} - {subject}" if business_name else subject
+    msg['Subject'] = personalized_subject
+    
+    # Add proper From header with sender name
+    msg['From'] = f'"{SENDER_NAME}" <{SMTP_USER}>'
+    msg['To'] = recipient_email
+    
+    # Add more headers to improve deliverability
+    # Add a unique Message-ID
+    msg['Message-ID'] = make_msgid(domain=SMTP_DOMAIN)
+    
+    # Add Date header (RFC 2822, with timezone)
+    msg['Date'] = formatdate(localtime=True)
+    
+    # Add X-Mailer header 
+    msg['X-Mailer'] = 'InvoiceCustomizer Service'
+    
+    # Add a List-Unsubscribe header (helps with spam prevention)
+    msg['List-Unsubscribe'] = f'<mailto:{SMTP_USER}?subject=Unsubscribe>'
+    
+    # Create personalized HTML content
+    html_content = _HTML_TEMPLATE.render(
+        subject=personalized_subject,
+        business_name=business_name,
+        brand_id=brand_id
+    )
     
     # Set both plain text and HTML content
     msg.set_content(body)
     msg.add_alternative(html_content, subtype='html')
 
     # Add attachments
-    for attachment_path in attachment_paths:
-        with open(attachment_path, 'rb') as f:
-            file_data = f.read()
-            file_name = os.path.basename(attachment_path)
-
-        if attachment_path.endswith('.xlsx'):
-            maintype = 'application'
-            subtype = 'vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-        else:
-            maintype = 'application'
-            subtype = 'octet-stream'
+    for file_name, file_data in attachments:
+        maintype, subtype = attachment_mime_type(file_name)
 
         msg.add_attachment(file_data, maintype=maintype, subtype=subtype, filename=file_name)
 
@@ -343,13 +637,12 @@ def send_email(recipient_email, subject, body, attachment_paths, business_name='
     
     for attempt in range(max_retries):
         try:
-            with smtplib.SMTP(smtp_server, smtp_port) as server:
-                server.starttls()
-                server.login(smtp_user, smtp_pass)
-                server.send_message(msg)
-                logger.info(f"✅ Email sent successfully to {recipient_email}")
-                return True
+            SMTP_POOL.send(msg)
+            logger.info(f"✅ Email sent successfully to {recipient_email}")
+            return True
         except Exception as e:
+            # Start the next attempt from a fresh connection
+            SMTP_POOL.close()
             if attempt < max_retries - 1:
                 logger.warning(f"⚠️ Email attempt {attempt + 1} failed. Retrying in {retry_delay} seconds: {e}")
                 time.sleep(retry_delay)
@@ -358,316 +651,586 @@ def send_email(recipient_email, subject, body, attachment_paths, business_name='
                 logger.error(f"❌ All email attempts failed: {e}")
                 return False
 
-def remove_background(image_file, tolerance=20):
+# (255, 255, 255, 0) packed the same way remove_background views its pixels
+_TRANSPARENT_WHITE = np.array([255, 255, 255, 0], dtype=np.uint8).view("<u4")[0]
+
+def remove_background(image_file, tolerance=BACKGROUND_TOLERANCE):
     """Remove background from logo image"""
-    img = Image.open(image_file).convert("RGBA")
-    datas = img.getdata()
+    img = Image.open(image_file)
+    # Image.open only reads the header, so reject oversized images before decoding
+    if img.width * img.height > MAX_LOGO_PIXELS:
+        raise ValueError(f"logo is {img.width}x{img.height}, over {MAX_LOGO_PIXELS} pixels")
+    img = img.convert("RGBA")
+    pixels = np.array(img)
 
-    new_data = []
-    background_color = datas[0]
-    logger.debug(f"Detected background color: {background_color}")
+    logger.debug(f"Detected background color: {tuple(pixels[0, 0])}")
     
-    for item in datas:
-        if all(abs(item[i] - background_color[i]) <= tolerance for i in range(3)):
-            new_data.append((255, 255, 255, 0))
-        else:
-            new_data.append(item)
-    img.putdata(new_data)
-    return img
+    # View each RGBA pixel as one little-endian uint32 (R in the low byte) so
+    # every channel comparison is a single shift+mask pass over packed ints
+    packed = pixels.view("<u4")[..., 0]
+    background = int(packed[0, 0])
+    
+    # Pixels whose RGB channels are all within tolerance of the background become transparent white
+    mask = np.ones(packed.shape, dtype=bool)
+    for shift in (0, 8, 16):
+        channel = ((packed >> shift) & 0xFF).astype(np.int16)
+        mask &= np.abs(channel - ((background >> shift) & 0xFF)) <= tolerance
+    packed[mask] = _TRANSPARENT_WHITE
+    return Image.fromarray(pixels, "RGBA")
 
-def update_notion_database(fields, event_id=None):
-    """Updates the Notion database with preview information using existing fields"""
-    if not NOTION_TOKEN or not DATABASE_ID:
-        logger.warning("⚠️ Notion credentials not set, skipping database update")
-        return
+def to_palette(img, colors=255):
+    """Quantize an RGBA image to an 8-bit palette image with 1-bit transparency"""
+    paletted = img.convert("RGB").quantize(colors=colors, method=Image.Quantize.FASTOCTREE)
+    alpha = img.getchannel("A")
+    if alpha.getextrema()[0] < 128:
+        # Append one transparent-white entry and point the see-through pixels at it
+        palette = paletted.getpalette()
+        transparent = len(palette) // 3
+        paletted.putpalette(palette + [255, 255, 255])
+        paletted.paste(transparent, mask=alpha.point(lambda a: 255 if a < 128 else 0))
+        paletted.info["transparency"] = transparent
+    return paletted
+
+def process_logo(logo_bytes, max_size=None, tolerance=BACKGROUND_TOLERANCE):
+    """Remove the logo background and return it as PNG bytes, downscaled to fit max_size"""
+    processed_logo = remove_background(io.BytesIO(logo_bytes), tolerance)
+    if max_size:
+        # Only the cell-sized logo is shown, so don't encode the full upload
+        processed_logo.thumbnail(max_size, Image.Resampling.LANCZOS)
+    png_buffer = io.BytesIO()
+    # 8-bit palette PNGs are several times smaller than RGBA for the same logo;
+    # fast zlib level since the PNG is deflated again inside the xlsx zip anyway
+    to_palette(processed_logo).save(png_buffer, format="PNG", compress_level=1)
+    return png_buffer.getvalue()
+
+def call_notion(func, **kwargs):
+    """Run a Notion API call under the shared rate limit and concurrency cap"""
+    NOTION_RATE_LIMITER.acquire()
+    with NOTION_SEMAPHORE:
+        return func(**kwargs)
+
+def _cached_notion_call(key, ttl, func, **kwargs):
+    """Call a Notion read endpoint, serving repeat calls from NOTION_CACHE until they expire.
     
-    try:
-        # Extract relevant information
-        business_name = fields.get('Company Name', 'Unknown')
-        email = fields.get('Email', '')
-        timestamp = datetime.now().isoformat()
-        
-        # Generate a unique Brand ID
-        brand_id = ""
-        if business_name and email:
-            brand_id = generate_brand_id(business_name, email)
-            fields['BrandID'] = brand_id
-        
-        # Prepare the data for Notion using only existing fields
-        properties = {
-            "Name": {"title": [{"text": {"content": business_name}}]},
-            "Email": {"email": email},
-            "Timestamp": {"date": {"start": timestamp}},
-            "Validated": {"checkbox": True},
-            "Email Sent": {"checkbox": False}  # Will be updated to True when email is sent
-        }
-        
-        # Add Brand ID to properties
-        if brand_id:
-            properties["BrandID"] = {"rich_text": [{"text": {"content": brand_id}}]}
-        
-        # If we have a company name, add it to the Company field
-        if fields.get('Company Name'):
-            properties["Company"] = {"rich_text": [{"text": {"content": fields.get('Company Name', '')}}]}
-        
-        # Check if this email already exists in the database
-        existing_pages = notion.databases.query(
-            database_id=DATABASE_ID,
-            filter={
-                "property": "Email",
-                "email": {
-                    "equals": email
-                }
-            }
-        ).get("results", [])
-        
-        if existing_pages:
-            # Update existing page
-            notion.pages.update(
-                page_id=existing_pages[0]["id"],
-                properties=properties
-            )
-            page_id = existing_pages[0]["id"]
-            logger.info(f"✅ Updated existing Notion entry for {business_name}")
-        else:
-            # Create new page
-            response = notion.pages.create(
-                parent={"database_id": DATABASE_ID},
-                properties=properties
-            )
-            page_id = response["id"]
-            logger.info(f"✅ Created new Notion entry for {business_name}")
-        
-        return page_id
-            
-    except Exception as e:
-        logger.error(f"⚠️ Error updating Notion database: {e}")
-        return None
-        
-def protect_workbook(workbook, password='etsysc123'):
-    """Apply protection to Excel workbook to prevent accidental changes"""
-    for sheet in workbook.worksheets:
-        # Enable protection with specific options
-        sheet.protection.sheet = True
-        sheet.protection.password = password
-        
-        # Disable object editing/deletion
-        sheet.protection.objects = True
-        sheet.protection.scenarios = True
-        
-        # Other protection options
-        sheet.protection.selectLockedCells = False
-        sheet.protection.selectUnlockedCells = False
-        sheet.protection.formatCells = False
-        sheet.protection.formatColumns = False
-        sheet.protection.formatRows = False
-        sheet.protection.insertColumns = False
-        sheet.protection.insertRows = False
-        sheet.protection.insertHyperlinks = False
-        sheet.protection.deleteColumns = False
-        sheet.protection.deleteRows = False
-        sheet.protection.sort = False
-        sheet.protection.autoFilter = False
-        sheet.protection.pivotTables = False
-        sheet.protection.drawings = True  # Specifically protects drawings/images
-        sheet.protection.print = False
-
-def insert_logo(ws, image_bytes):
-    """Insert logo into worksheet"""
-    # Create a temporary file that won't be deleted until program exit
-    temp_logo = tempfile.NamedTemporaryFile(delete=False, suffix=".png")
-    temp_logo.write(image_bytes)
-    temp_logo.close()  # Close the file but don't delete it
+    key is (call name, page or block id, page_size or None).
+    """
+    now = time.time()
+    with _NOTION_CACHE_LOCK:
+        entry = NOTION_CACHE.get(key)
+        if entry:
+            if entry[0] > now:
+                return entry[1]
+            del NOTION_CACHE[key]
+    
+    value = call_notion(func, **kwargs)
+    with _NOTION_CACHE_LOCK:
+        NOTION_CACHE[key] = (now + ttl, value)
+        NOTION_CACHE.move_to_end(key)
+        while len(NOTION_CACHE) > MAX_NOTION_CACHE_SIZE:
+            NOTION_CACHE.popitem(last=False)
+    return value
 
-    try:
-        img = OpenpyxlImage(temp_logo.name)
-        col_width = ws.column_dimensions['A'].width or 8
-        row_height = ws.row_dimensions[1].height or 15
+def notion_query(**kwargs):
+    """notion.databases.query under the shared rate limit (not cached)"""
+    return call_notion(notion.databases.query, **kwargs)
 
-        img.width = int(col_width * 7.5)
-        img.height = int(row_height * 1.33)
-        img.anchor = 'A1'
+def notion_retrieve_page(page_id):
+    """Cached notion.pages.retrieve"""
+    return _cached_notion_call(("pages.retrieve", page_id, None), NOTION_PAGE_TTL,
+                               notion.pages.retrieve, page_id=page_id)
 
-        ws.add_image(img)
-        
-        # Return the filename so we can delete it after the workbook is saved
-        return temp_logo.name
-    except Exception as e:
-        logger.error(f"⚠️ Error adding logo: {e}")
-        # If there's an error, try to clean up the file
-        try:
-            os.unlink(temp_logo.name)
-        except:
-            pass
-        return None
+def notion_list_blocks(block_id, page_size=50):
+    """Cached notion.blocks.children.list"""
+    return _cached_notion_call(("blocks.children.list", block_id, page_size), NOTION_PAGE_TTL,
+                               notion.blocks.children.list, block_id=block_id, page_size=page_size)
+
+def invalidate_notion_cache(page_id):
+    """Drop a page's cached reads after writing to it"""
+    with _NOTION_CACHE_LOCK:
+        for key in [key for key in NOTION_CACHE if key[1] == page_id]:
+            del NOTION_CACHE[key]
 
-def insert_watermark_background(ws):
-    """Insert watermark into worksheet"""
-    if os.path.exists("watermark.png"):
-        with open("watermark.png", 'rb') as img_file:
-            ws._background = img_file.read()
-
-def extract_notion_properties(page):
-    """Extract relevant properties from a Notion page"""
-    properties = page.get("properties", {})
-    fields = {}
-    
-    # Extract Company Name
-    title_property = next((prop_name for prop_name, prop in properties.items() 
-                         if prop.get("type") == "title"), None)
-    if title_property:
-        title_objects = properties[title_property].get("title", [])
-        if title_objects:
-            fields["Company Name"] = title_objects[0].get("plain_text", "")
-    
-    # Extract Email
-    email_property = next((prop_name for prop_name, prop in properties.items() 
-                         if prop.get("type") == "email"), None)
-    if email_property:
-        fields["Email"] = properties[email_property].get("email", "")
-    
-    # Extract Logo URL
-    for prop_name, prop in properties.items():
-        if prop.get("type") == "url" and "logo" in prop_name.lower():
-            fields["Logo URL"] = prop.get("url", "")
-        elif prop.get("type") == "rich_text" and "logo" in prop_name.lower():
-            rich_texts = prop.get("rich_text", [])
-            if rich_texts:
-                fields["Logo URL"] = rich_texts[0].get("plain_text", "")
-    
-    # Extract Address
-    for prop_name, prop in properties.items():
-        if prop.get("type") == "rich_text" and "address" in prop_name.lower():
-            rich_texts = prop.get("rich_text", [])
-            if rich_texts:
-                fields["Address"] = rich_texts[0].get("plain_text", "")
-    
-    # Extract City, State ZIP
-    for prop_name, prop in properties.items():
-        if prop.get("type") == "rich_text" and ("city" in prop_name.lower() or "zip" in prop_name.lower()):
-            rich_texts = prop.get("rich_text", [])
-            if rich_texts:
-                fields["City, State ZIP"] = rich_texts[0].get("plain_text", "")
-    
-    # Extract Phone
-    for prop_name, prop in properties.items():
-        if prop.get("type") == "phone_number" or (prop.get("type") == "rich_text" and "phone" in prop_name.lower()):
-            if prop.get("type") == "phone_number":
-                fields["Phone"] = prop.get("phone_number", "")
+def sweep_notion_cache():
+    """Drop expired Notion cache entries"""
+    now = time.time()
+    with _NOTION_CACHE_LOCK:
+        for key, (expires_at, _) in list(NOTION_CACHE.items()):
+            if expires_at <= now:
+                del NOTION_CACHE[key]
+
+def queue_notion_update(page_id, properties):
+    """Queue a Notion page update to be sent with the next batch"""
+    with _UNCONFIRMED_UPDATES_LOCK:
+        _UNCONFIRMED_UPDATES.add(page_id)
+    NOTION_UPDATE_QUEUE.put((page_id, properties, time.time(), 0, 0))
+
+def unconfirmed_notion_updates(page_ids):
+    """Return the pages among page_ids whose queued Notion write hasn't landed"""
+    with _UNCONFIRMED_UPDATES_LOCK:
+        return _UNCONFIRMED_UPDATES.intersection(page_ids)
+
+def flush_notion_updates():
+    """Send all due Notion page updates concurrently, one write per page.
+    
+    Failed updates are retried with backoff until NOTION_UPDATE_MAX_ATTEMPTS,
+    then dropped. Returns (updated, failed) for this flush.
+    """
+    # Merge updates queued for the same page so each page costs a single write
+    merged = {}
+    while True:
+        try:
+            page_id, properties, queued_at, attempts, retry_at = NOTION_UPDATE_QUEUE.get_nowait()
+        except queue.Empty:
+            break
+        if page_id in merged:
+            _, merged_properties, first_queued, merged_attempts, merged_retry = merged[page_id]
+            merged_properties.update(properties)
+            merged[page_id] = (page_id, merged_properties, min(first_queued, queued_at),
+                               max(merged_attempts, attempts), max(merged_retry, retry_at))
+        else:
+            merged[page_id] = (page_id, dict(properties), queued_at, attempts, retry_at)
+    
+    # Writes still backing off go back on the queue untouched
+    now = time.time()
+    pending = []
+    for item in merged.values():
+        if item[4] > now:
+            NOTION_UPDATE_QUEUE.put(item)
+        else:
+            pending.append(item)
+    if not pending:
+        return 0, 0
+    
+    def _update(item):
+        page_id, properties, queued_at, attempts, _ = item
+        try:
+            call_notion(notion.pages.update, page_id=page_id, properties=properties)
+            invalidate_notion_cache(page_id)
+            with _UNCONFIRMED_UPDATES_LOCK:
+                _UNCONFIRMED_UPDATES.discard(page_id)
+            return True
+        except Exception as e:
+            attempts += 1
+            if attempts >= NOTION_UPDATE_MAX_ATTEMPTS:
+                # Left in _UNCONFIRMED_UPDATES so the run that sent it doesn't count as clean
+                logger.error(f"❌ Giving up on Notion page {page_id} after {attempts} attempts "
+                             f"(queued {time.time() - queued_at:.1f}s ago): {e}")
             else:
-                rich_texts = prop.get("rich_text", [])
-                if rich_texts:
-                    fields["Phone"] = rich_texts[0].get("plain_text", "")
-    
-    # Extract Tax %
-    for prop_name, prop in properties.items():
-        if prop.get("type") == "number" and prop_name == "Tax Percentage":
-            tax_value = prop.get("number")
-            if tax_value is not None:  # Check if it's actually a value and not None
-                fields["Tax %"] = str(tax_value)
-                print(f"✅ Found Tax Percentage: {tax_value}")
-                tax_found = True
-                break
+                # The email already went out, so keep the write rather than resend later
+                delay = NOTION_UPDATE_BACKOFF * 2 ** (attempts - 1)
+                logger.warning(f"⚠️ Failed to update Notion page {page_id} "
+                               f"(attempt {attempts}, retrying in {delay}s): {e}")
+                NOTION_UPDATE_QUEUE.put((page_id, properties, queued_at, attempts, time.time() + delay))
+            return False
     
-    # Extract Currency
-    for prop_name, prop in properties.items():
-        if prop.get("type") == "select" and "currency" in prop_name.lower():
-            select = prop.get("select", {})
-            fields["Currency"] = select.get("name", "USD")
-        elif prop.get("type") == "rich_text" and "currency" in prop_name.lower():
-            rich_texts = prop.get("rich_text", [])
-            if rich_texts:
-                fields["Currency"] = rich_texts[0].get("plain_text", "USD")
-    
-    # Extract BrandID if it exists
-    for prop_name, prop in properties.items():
-        if prop.get("type") == "rich_text" and "brandid" in prop_name.lower():
-            rich_texts = prop.get("rich_text", [])
-            if rich_texts:
-                fields["BrandID"] = rich_texts[0].get("plain_text", "")
-    
-    return fields
-
-def process_template(fields, page_id):
-    """Generate a customized template based on customer fields and Notion page ID"""
-    temp_files = []  # List to keep track of temporary files to clean up
+    with ThreadPoolExecutor(max_workers=NOTION_UPDATE_WORKERS) as executor:
+        updated = sum(executor.map(_update, pending))
     
+    logger.info(f"✅ Flushed {updated}/{len(pending)} queued Notion update(s)")
+    return updated, len(pending) - updated
+
+# === XLSX TEMPLATE ===
+# The invoice template is fixed, so instead of round-tripping it through openpyxl
+# we patch the few XML parts that change and copy everything else byte-for-byte.
+INVOICE_SHEET = "xl/worksheets/sheet1.xml"
+INVOICE_SHEET_RELS = "xl/worksheets/_rels/sheet1.xml.rels"
+WORKBOOK_PASSWORD = "etsysc123"
+
+# Characters that are not allowed in XML 1.0 documents
+_ILLEGAL_XML_CHARS_RE = re.compile(r'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+_COL_A_WIDTH_RE = re.compile(r'<col min="1" max="\d+" width="([\d.]+)"')
+_ROW_1_HEIGHT_RE = re.compile(r'<row r="1" [^>]*?ht="([\d.]+)"')
+
+_DRAWING_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<xdr:wsDr xmlns:xdr="http://schemas.openxmlformats.org/drawingml/2006/spreadsheetDrawing" '
+    'xmlns:a="http://schemas.openxmlformats.org/drawingml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<xdr:oneCellAnchor><xdr:from><xdr:col>0</xdr:col><xdr:colOff>0</xdr:colOff>'
+    '<xdr:row>0</xdr:row><xdr:rowOff>0</xdr:rowOff></xdr:from>'
+    '<xdr:ext cx="{cx}" cy="{cy}"/>'
+    '<xdr:pic><xdr:nvPicPr><xdr:cNvPr id="1" name="Logo"/><xdr:cNvPicPr/></xdr:nvPicPr>'
+    '<xdr:blipFill><a:blip r:embed="rId1"/><a:stretch><a:fillRect/></a:stretch></xdr:blipFill>'
+    '<xdr:spPr><a:prstGeom prst="rect"><a:avLst/></a:prstGeom></xdr:spPr></xdr:pic>'
+    '<xdr:clientData/></xdr:oneCellAnchor></xdr:wsDr>'
+)
+_DRAWING_RELS_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/image" '
+    'Target="../media/logo.png"/></Relationships>'
+)
+_DRAWING_REL = (
+    '<Relationship Id="rIdLogo" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/drawing" '
+    'Target="../drawings/drawing1.xml"/>'
+)
+_DRAWING_CONTENT_TYPE = (
+    '<Override PartName="/xl/drawings/drawing1.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.drawing+xml"/>'
+)
+
+def sheet_protection_xml(password=WORKBOOK_PASSWORD):
+    """Build the <sheetProtection> element applied to every worksheet"""
+    options = {
+        "sheet": True,
+        "objects": True,  # Disable object editing/deletion
+        "scenarios": True,
+        "selectLockedCells": False,
+        "selectUnlockedCells": False,
+        "formatCells": False,
+        "formatColumns": False,
+        "formatRows": False,
+        "insertColumns": False,
+        "insertRows": False,
+        "insertHyperlinks": False,
+        "deleteColumns": False,
+        "deleteRows": False,
+        "sort": False,
+        "autoFilter": False,
+        "pivotTables": False,
+    }
+    attrs = " ".join(f'{name}="{int(value)}"' for name, value in options.items())
+    return f'<sheetProtection password="{hash_password(password)}" {attrs}/>'
+
+def _xml_text(value):
+    """Escape a value for use as XML element text"""
+    return xml_escape(_ILLEGAL_XML_CHARS_RE.sub("", str(value)))
+
+def _column_key(ref):
+    """Sort key for a column reference so that 'B' < 'Z' < 'AA'"""
+    letters = ref.rstrip("0123456789")
+    return len(letters), letters
+
+def set_cell(sheet_xml, ref, cell_type, inner, style=None):
+    """Replace (or insert) cell `ref` in a worksheet's XML, keeping its style unless one is given"""
+    cell_re = re.compile(r'<c r="%s"(?P<attrs>[^>]*?)(?:/>|>.*?</c>)' % ref)
+    match = cell_re.search(sheet_xml)
+    if match:
+        if style is None:
+            existing = re.search(r' s="(\d+)"', match.group("attrs"))
+            style = existing.group(1) if existing else None
+        attrs = f' s="{style}"' if style is not None else ""
+        if cell_type:
+            attrs += f' t="{cell_type}"'
+        cm = re.search(r' cm="\d+"', match.group("attrs"))
+        if cm and inner.startswith("<f"):
+            attrs += cm.group()
+        return f'{sheet_xml[:match.start()]}<c r="{ref}"{attrs}>{inner}</c>{sheet_xml[match.end():]}'
+
+    # Cell doesn't exist yet: insert it into its row in column order
+    row = ref.lstrip("ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+    row_match = re.search(r'<row r="%s"[^>]*?(?:/>|>(?P<cells>.*?)</row>)' % row, sheet_xml)
+    if not row_match:
+        raise ValueError(f"Row {row} not found in template for cell {ref}")
+    new_cell = (f'<c r="{ref}"' + (f' s="{style}"' if style is not None else "")
+                + (f' t="{cell_type}"' if cell_type else "") + f'>{inner}</c>')
+    if row_match.group("cells") is None:
+        row_open = row_match.group()[:-2] + ">"
+        return f'{sheet_xml[:row_match.start()]}{row_open}{new_cell}</row>{sheet_xml[row_match.end():]}'
+    insert_at = row_match.end("cells")
+    for cell in re.finditer(r'<c r="([A-Z]+)%s"' % row, row_match.group("cells")):
+        if _column_key(cell.group(1)) > _column_key(ref):
+            insert_at = row_match.start("cells") + cell.start()
+            break
+    return sheet_xml[:insert_at] + new_cell + sheet_xml[insert_at:]
+
+def set_cell_value(sheet_xml, ref, value):
+    """Write a string value into a cell as an inline string"""
+    if value in (None, ""):
+        return sheet_xml
+    return set_cell(sheet_xml, ref, "inlineStr", f'<is><t xml:space="preserve">{_xml_text(value)}</t></is>')
+
+def set_cell_formula(sheet_xml, ref, formula):
+    """Write a formula into a cell (without a cached value, so Excel recalculates it)"""
+    return set_cell(sheet_xml, ref, None, f'<f t="array" aca="1" ref="{ref}" ca="1">{_xml_text(formula.lstrip("="))}</f>')
+
+def _add_center_style(styles_xml):
+    """Append a centered-alignment cell format to styles.xml; returns (xml, style index)"""
+    count = int(re.search(r'<cellXfs count="(\d+)"', styles_xml).group(1))
+    xf = ('<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0" applyAlignment="1">'
+          '<alignment horizontal="center" vertical="center"/></xf>')
+    styles_xml = styles_xml.replace(f'<cellXfs count="{count}"', f'<cellXfs count="{count + 1}"', 1)
+    styles_xml = styles_xml.replace("</cellXfs>", xf + "</cellXfs>", 1)
+    return styles_xml, count
+
+def _merge_cells(sheet_xml, ref):
+    """Add a merged range to a worksheet's XML"""
+    match = re.search(r'<mergeCells count="(\d+)">', sheet_xml)
+    if match:
+        count = int(match.group(1))
+        sheet_xml = sheet_xml.replace(match.group(), f'<mergeCells count="{count + 1}">', 1)
+        return sheet_xml.replace("</mergeCells>", f'<mergeCell ref="{ref}"/></mergeCells>', 1)
+    merge_xml = f'<mergeCells count="1"><mergeCell ref="{ref}"/></mergeCells>'
+    for anchor in ("<phoneticPr", "<conditionalFormatting", "<dataValidations", "<hyperlinks",
+                   "<printOptions", "<pageMargins", "<pageSetup", "<headerFooter", "</worksheet>"):
+        if anchor in sheet_xml:
+            return sheet_xml.replace(anchor, merge_xml + anchor, 1)
+    return sheet_xml
+
+def _prepare_template(template_bytes):
+    """Apply the per-template (request-independent) patches once at startup"""
+    with zipfile.ZipFile(io.BytesIO(template_bytes)) as zf:
+        parts = {info.filename: zf.read(info) for info in zf.infolist()}
+
+    protection = sheet_protection_xml()
+    for name in parts:
+        if name.startswith("xl/worksheets/sheet") and name.endswith(".xml"):
+            sheet_xml = parts[name].decode("utf-8")
+            sheet_xml = re.sub(r'<sheetProtection[^>]*/>', "", sheet_xml)
+            sheet_xml = sheet_xml.replace("</sheetData>", "</sheetData>" + protection, 1)
+            parts[name] = sheet_xml.encode("utf-8")
+
+    styles_xml, center_style = _add_center_style(parts["xl/styles.xml"].decode("utf-8"))
+    parts["xl/styles.xml"] = styles_xml.encode("utf-8")
+
+    sheet_xml = parts[INVOICE_SHEET].decode("utf-8")
+    sheet_xml = set_cell(sheet_xml, "C32", None, "", style=center_style)
+    sheet_xml = _merge_cells(sheet_xml, "C32:E32")
+    parts[INVOICE_SHEET] = sheet_xml.encode("utf-8")
+
+    # Cached formula results are stale once we change the tax rate
+    workbook_xml = parts["xl/workbook.xml"].decode("utf-8")
+    workbook_xml = re.sub(r'<calcPr([^>]*?)/>', r'<calcPr\1 fullCalcOnLoad="1"/>', workbook_xml, count=1)
+    parts["xl/workbook.xml"] = workbook_xml.encode("utf-8")
+
+    content_types = parts["[Content_Types].xml"].decode("utf-8")
+    if 'Extension="png"' not in content_types:
+        content_types = content_types.replace(
+            "<Default ", '<Default Extension="png" ContentType="image/png"/><Default ', 1)
+    parts["[Content_Types].xml"] = content_types.encode("utf-8")
+
+    rels_xml = parts.get(INVOICE_SHEET_RELS, (
+        b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        b'<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships"></Relationships>'
+    )).decode("utf-8")
+    parts[INVOICE_SHEET_RELS] = rels_xml.encode("utf-8")
+
+    # Logo size follows the width of column A and the height of row 1
+    col_width = _COL_A_WIDTH_RE.search(sheet_xml)
+    row_height = _ROW_1_HEIGHT_RE.search(sheet_xml)
+    logo_width = int((float(col_width.group(1)) if col_width else 8) * 7.5)
+    logo_height = int((float(row_height.group(1)) if row_height else 15) * 1.33)
+
+    return parts, (logo_width, logo_height)
+
+with open(TEMPLATE_PATH, 'rb') as template_file:
+    TEMPLATE_BYTES = template_file.read()
+_TEMPLATE_PARTS, _LOGO_SIZE = _prepare_template(TEMPLATE_BYTES)
+# Processed logos are kept at 2x the displayed cell size so they stay sharp on HiDPI screens
+LOGO_MAX_SIZE = (_LOGO_SIZE[0] * 2, _LOGO_SIZE[1] * 2)
+# Everything besides the source bytes that shapes a processed logo; part of its cache key
+_LOGO_VARIANT = (f"v{LOGO_PROCESS_VERSION}-{LOGO_MAX_SIZE[0]}x{LOGO_MAX_SIZE[1]}"
+                 f"-t{BACKGROUND_TOLERANCE}").encode("ascii")
+
+# Parts build_invoice_xlsx may rewrite; everything else is identical for every
+# invoice, so it is compressed into a base zip once and appended to per build
+_VARIABLE_PARTS = ("[Content_Types].xml", INVOICE_SHEET, INVOICE_SHEET_RELS)
+
+def _build_static_zip(parts):
+    """Zip every template part that never changes between invoices"""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as zf:
+        for name, data in parts.items():
+            if name not in _VARIABLE_PARTS:
+                zf.writestr(name, data)
+    return buf.getvalue()
+
+_STATIC_ZIP = _build_static_zip(_TEMPLATE_PARTS)
+
+def build_invoice_xlsx(fields, logo_png=None):
+    """Fill the invoice template with customer fields and return the .xlsx bytes"""
+    business_name = fields.get("Company Name", "Your Business")
+    tax_percentage = fields.get("Tax %", "7")
+    currency = fields.get("Currency", "USD")
+
+    sheet_xml = _TEMPLATE_PARTS[INVOICE_SHEET].decode("utf-8")
+    sheet_xml = set_cell_value(sheet_xml, "A2", business_name)
+    sheet_xml = set_cell_value(sheet_xml, "A3", fields.get("Address", ""))
+    sheet_xml = set_cell_value(sheet_xml, "A4", fields.get("City, State ZIP", ""))
+    sheet_xml = set_cell_value(sheet_xml, "A5", fields.get("Phone", ""))
+    sheet_xml = set_cell_value(sheet_xml, "A6", fields.get("Email", ""))
+    sheet_xml = set_cell_value(sheet_xml, "D30", f"Tax ({tax_percentage}%)")
+    sheet_xml = set_cell_formula(sheet_xml, "E30", f'=IF(NOT(IsGoogleSheets),E29*{float(tax_percentage)}/100,"GOOGLE SHEETS DETECTED")')
+    sheet_xml = set_cell_value(sheet_xml, "C32", f"All amounts shown in {currency}")
+
+    overrides = {}
+    tail = ""
+    if logo_png:
+        width, height = _LOGO_SIZE
+        overrides["xl/media/logo.png"] = logo_png
+        overrides["xl/drawings/drawing1.xml"] = _DRAWING_XML.format(cx=width * 9525, cy=height * 9525).encode("utf-8")
+        overrides["xl/drawings/_rels/drawing1.xml.rels"] = _DRAWING_RELS_XML.encode("utf-8")
+        rels_xml = _TEMPLATE_PARTS[INVOICE_SHEET_RELS].decode("utf-8")
+        overrides[INVOICE_SHEET_RELS] = rels_xml.replace("</Relationships>", _DRAWING_REL + "</Relationships>", 1).encode("utf-8")
+        content_types = _TEMPLATE_PARTS["[Content_Types].xml"].decode("utf-8")
+        overrides["[Content_Types].xml"] = content_types.replace("</Types>", _DRAWING_CONTENT_TYPE + "</Types>", 1).encode("utf-8")
+        tail += '<drawing r:id="rIdLogo"/>'
+    overrides[INVOICE_SHEET] = sheet_xml.replace("</worksheet>", tail + "</worksheet>", 1).encode("utf-8")
+
+    # Start from the pre-compressed static parts and only deflate what changed
+    buf = io.BytesIO(_STATIC_ZIP)
+    with zipfile.ZipFile(buf, "a", zipfile.ZIP_DEFLATED) as zf:
+        for name in _VARIABLE_PARTS:
+            if name in _TEMPLATE_PARTS:
+                zf.writestr(name, overrides.pop(name, _TEMPLATE_PARTS[name]))
+        for name, data in overrides.items():
+            zf.writestr(name, data)
+    return buf.getvalue()
+
+# Anything but letters, digits, "_" and "-" is replaced in attachment filenames
+_UNSAFE_FILENAME_RE = re.compile(r'[^\w\-]+')
+
+def invoice_filename(business_name):
+    """Attachment filename for a business's invoice template"""
+    safe_name = _UNSAFE_FILENAME_RE.sub("_", business_name).strip("_")
+    return f"{safe_name or 'Invoice'}_invoice.xlsx"
+
+def process_template(fields, page_id, properties=None):
+    """Generate a customized template; returns (xlsx bytes, attachment filename) or (None, None)"""
     try:
         business_name = fields.get("Company Name", "Your Business")
-        address1 = fields.get("Address", "")
-        address2 = fields.get("City, State ZIP", "")
-        phone = fields.get("Phone", "")
-        email = fields.get("Email", "")
-        tax_percentage = fields.get("Tax %", "7")
-        currency = fields.get("Currency", "USD")
         
         # Get logo directly from Notion page
-        logo_bytes = get_logo_from_notion(page_id)
+        logo_bytes = get_logo_from_notion(page_id, properties)
         
         if not logo_bytes:
             logger.warning(f"No logo found for {business_name}, proceeding without logo")
             # Continue with template generation without logo
         else:
             # Process the logo to remove background if logo exists
-            try:
-                processed_logo = remove_background(io.BytesIO(logo_bytes))
-                logo_bytes_io = io.BytesIO()
-                processed_logo.save(logo_bytes_io, format="PNG")
-                logo_bytes_io.seek(0)
-                logo_bytes = logo_bytes_io.read()
-            except Exception as e:
-                logger.error(f"Error processing logo: {e}")
-                # Continue with the original logo if processing fails
-                logo_bytes_io = io.BytesIO(logo_bytes)
-        
-        # Load template and customize
-        wb = openpyxl.load_workbook(TEMPLATE_PATH)
-        ws = wb.active
-        
-        insert_watermark_background(ws)
-        
-        # Insert business information
-        ws['A2'] = business_name
-        ws['A3'] = address1
-        ws['A4'] = address2
-        ws['A5'] = phone
-        ws['A6'] = email
-        ws['D30'] = f"Tax ({tax_percentage}%)"
-        ws['E30'] = f'=IF(NOT(IsGoogleSheets),E29*{float(tax_percentage)}/100,"GOOGLE SHEETS DETECTED")'
-        ws['C32'] = f"All amounts shown in {currency}"
-        ws.merge_cells('C32:E32')
-        ws['C32'].alignment = Alignment(horizontal='center', vertical='center')
-        
-        # Insert logo if available
-        if logo_bytes:
-            logo_temp_path = insert_logo(ws, logo_bytes)
-            if logo_temp_path:
-                temp_files.append(logo_temp_path)
-        
-        # Apply protection
-        protect_workbook(wb)
+            logo_key = _LOGO_VARIANT + b":" + hashlib.blake2b(logo_bytes, digest_size=16).digest()
+            cached_logo = PROCESSED_LOGO_CACHE.get(logo_key)
+            if cached_logo is None:
+                cached_logo = read_logo_cache("png", logo_key)
+                if cached_logo is not None:
+                    PROCESSED_LOGO_CACHE.set(logo_key, cached_logo)
+            if cached_logo is not None:
+                logo_bytes = cached_logo
+            else:
+                try:
+                    # Pillow and NumPy release the GIL for the heavy parts, so run it in-thread
+                    logo_bytes = process_logo(logo_bytes, LOGO_MAX_SIZE)
+                    PROCESSED_LOGO_CACHE.set(logo_key, logo_bytes)
+                    write_logo_cache("png", logo_key, logo_bytes)
+                except Exception as e:
+                    # The raw download may not be a PNG (SVG, WebP, corrupt data),
+                    # so leave the logo out rather than embed it as logo.png
+                    logger.error(f"Error processing logo, proceeding without logo: {e}")
+                    logo_bytes = None
         
-        # Save to temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".xlsx") as tmp:
-            wb.save(tmp.name)
-            temp_files.append(tmp.name)
-            return tmp.name, temp_files
+        # Filling the template only appends a few parts to a pre-built zip
+        xlsx_bytes = build_invoice_xlsx(fields, logo_bytes)
+        return xlsx_bytes, invoice_filename(business_name)
     
     except Exception as e:
         logger.error(f"Error processing template: {e}")
-        return None, temp_files
+        return None, None
+
+def _logo_cache_path(kind, key):
+    """File path for a logo cache entry"""
+    digest = hashlib.sha256(key.encode("utf-8") if isinstance(key, str) else key).hexdigest()
+    return os.path.join(LOGO_CACHE_DIR, f"{kind}-{digest}")
+
+def read_logo_cache(kind, key):
+    """Return cached bytes for (kind, key), or None if missing or older than LOGO_CACHE_TTL"""
+    path = _logo_cache_path(kind, key)
+    try:
+        if time.time() - os.path.getmtime(path) > LOGO_CACHE_TTL:
+            return None
+        with open(path, 'rb') as cache_file:
+            return cache_file.read()
+    except OSError:
+        return None
 
-def get_logo_from_notion(page_id):
+def write_logo_cache(kind, key, data):
+    """Store bytes for (kind, key); written to a temp name first so readers never see a partial file"""
+    path = _logo_cache_path(kind, key)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(LOGO_CACHE_DIR, exist_ok=True)
+        with open(tmp_path, 'wb') as cache_file:
+            cache_file.write(data)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Could not write logo cache entry: {e}")
+
+def sweep_logo_cache():
+    """Delete logo cache files older than LOGO_CACHE_TTL"""
+    cutoff = time.time() - LOGO_CACHE_TTL
+    try:
+        entries = list(os.scandir(LOGO_CACHE_DIR))
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.unlink(entry.path)
+        except OSError:
+            pass
+
+def fetch_logo(url, file_type):
+    """Download a logo, serving repeat URLs from the disk cache"""
+    # Notion-hosted files come back with a fresh signature each time; the path
+    # (which embeds the file's ID) is the stable part
+    cache_key = url.split("?", 1)[0] if file_type == "file" else url
+    content = read_logo_cache("src", cache_key)
+    if content is not None and is_image(content):
+        return content
+    content = download_bytes(url)
+    if content is None:
+        return None
+    # An error page served with a 200 must not be cached (or used) as the logo
+    if not is_image(content):
+        logger.warning(f"Skipping {url}: response is not a readable image")
+        return None
+    write_logo_cache("src", cache_key, content)
+    return content
+
+def is_image(data):
+    """True if Pillow can identify and verify data as an image, without decoding it"""
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            img.verify()
+        return True
+    except Exception:
+        return False
+
+def download_bytes(url, max_bytes=MAX_LOGO_BYTES):
+    """Stream a URL through the shared HTTP session; returns the body, or None if it failed or is too large"""
+    try:
+        with HTTP_SESSION.get(url, timeout=HTTP_TIMEOUT, stream=True) as resp:
+            if not resp.ok:
+                return None
+            if int(resp.headers.get("Content-Length") or 0) > max_bytes:
+                logger.warning(f"Skipping {url}: Content-Length over {max_bytes} bytes")
+                return None
+            buffer = bytearray()
+            for chunk in resp.iter_content(chunk_size=HTTP_CHUNK_SIZE):
+                buffer.extend(chunk)
+                if len(buffer) > max_bytes:
+                    logger.warning(f"Skipping {url}: body over {max_bytes} bytes")
+                    return None
+            return bytes(buffer)
+    except requests.RequestException as e:
+        # Retries exhausted (RetryError), timeouts and connection errors all land here;
+        # return None so callers fall through to their next logo source
+        logger.warning(f"Could not download {url}: {e}")
+        return None
+
+
+def get_logo_from_notion(page_id, properties=None):
     """
     Try, in order:
       1) The "Logo" Files & media property on the page
       2) Any image block in the page body
+    Pass the page's already-fetched properties to skip retrieving it again.
     Returns raw bytes or None.
     """
     try:
-        # 1) Retrieve the full page so we can inspect its properties
-        page = notion.pages.retrieve(page_id=page_id)
-        props = page.get("properties", {})
+        if properties is None:
+            # 1) Retrieve the full page so we can inspect its properties
+            properties = notion_retrieve_page(page_id).get("properties", {})
+        props = properties
 
         # 2) Look explicitly for your "Logo" column
         logo_prop = props.get("Logo")
@@ -679,23 +1242,24 @@ def get_logo_from_notion(page_id):
                 url = (file["external"]["url"]
                        if file["type"] == "external"
                        else file["file"]["url"])
-                resp = requests.get(url)
-                if resp.ok:
+                content = fetch_logo(url, file["type"])
+                if content is not None:
                     logger.info(f"✅ Pulled logo from DB property for page {page_id}")
-                    return resp.content
+                    return content
 
-        # 3) Fallback: scan the page’s child blocks for any image block
-        blocks = notion.blocks.children.list(block_id=page_id).get("results", [])
+        # 3) Fallback: scan the page’s child blocks for any image block; only
+        #    listed once the property lookup misses, to save a rate-limited call
+        blocks = notion_list_blocks(page_id).get("results", [])
         for block in blocks:
             if block["type"] == "image":
                 img = block["image"]
                 url = (img["external"]["url"]
                        if img["type"] == "external"
                        else img["file"]["url"])
-                resp = requests.get(url)
-                if resp.ok:
+                content = fetch_logo(url, img["type"])
+                if content is not None:
                     logger.info(f"✅ Pulled logo from image block for page {page_id}")
-                    return resp.content
+                    return content
 
         logger.warning(f"No logo found for page {page_id}")
     except Exception as e:
@@ -704,20 +1268,26 @@ def get_logo_from_notion(page_id):
     return None
 
 
+def brand_id_properties(brand_id=None, email_sent=False):
+    """Build the Notion properties for a Brand ID and/or email status write"""
+    properties = {}
+    if brand_id:
+        properties["BrandID"] = {"rich_text": [{"text": {"content": brand_id}}]}
+    if email_sent:
+        properties["Email Sent"] = {"checkbox": True}
+    return properties
+
 def update_notion_with_brand_id(page_id, brand_id, email_sent=False):
     """Update Notion record with Brand ID and email status"""
     try:
-        properties = {
-            "BrandID": {"rich_text": [{"text": {"content": brand_id}}]}
-        }
-        
-        if email_sent:
-            properties["Email Sent"] = {"checkbox": True}
+        properties = brand_id_properties(brand_id, email_sent)
         
-        notion.pages.update(
+        call_notion(
+            notion.pages.update,
             page_id=page_id,
             properties=properties
         )
+        invalidate_notion_cache(page_id)
         logger.info(f"✅ Updated Notion page {page_id} with Brand ID {brand_id}")
         return True
     except Exception as e:
@@ -725,6 +1295,152 @@ def update_notion_with_brand_id(page_id, brand_id, email_sent=False):
         return False
 
 # === PROCESSING FUNCTION ===
+def _process_record(record):
+    """Generate, email and record the invoice for one Notion page.
+    
+    Returns True if it was sent, False if it failed, None if it was skipped and
+    RECORD_IN_FLIGHT if another run has claimed the page.
+    """
+    page_id    = record["id"]
+    properties = record.get("properties", {})
+
+    # Dump the actual property keys so you can verify names
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Properties for page %s: %s", page_id, list(properties))
+
+    # Pages that already have a Brand ID and a sent email can slip through
+    # the query (e.g. the overlap window); skip them before doing any work
+    existing_brand_id = get_property_value(properties, "BrandID", "rich_text")
+    if existing_brand_id and get_property_value(properties, "Email Sent", "checkbox"):
+        logger.info("↪️ Skipping page %s, already has Brand ID and email sent", page_id)
+        return None
+
+    # 2) Extract your fields
+    business_name   = get_property_value(properties, "Company",     "rich_text")
+    etsy_email      = get_property_value(properties, "Etsy Email",  "email")
+    phone           = get_property_value(properties, "Phone",       "phone_number")
+    address         = get_property_value(properties, "Address",     "rich_text")
+    city_state_zip  = get_property_value(properties, "CityStateZip","rich_text")
+    tax_percentage  = get_property_value(properties, "Tax Percentage", "number") or "7"
+
+    # 3) Skip invalid entries
+    if not business_name or not etsy_email:
+        logger.warning("Skipping %s: missing Company or Etsy Email", page_id)
+        return None
+
+    # 4) Brand ID: reuse if present, else generate with the Etsy email
+    if existing_brand_id:
+        brand_id = existing_brand_id
+        logger.info("↪️ Using existing Brand ID %s for %s", brand_id, business_name)
+    else:
+        brand_id = generate_brand_id(business_name, etsy_email)
+        logger.info("✨ Generated Brand ID %s for %s", brand_id, business_name)
+
+    # 5) Build a minimal fields dict for your template step
+    fields = {
+        "Company Name": business_name,
+        "Address":      address,
+        "City, State ZIP": city_state_zip,
+        "Phone":        phone,
+        "Email":        etsy_email,
+        "Tax %":        str(tax_percentage),
+        "Currency":     "USD",
+    }
+
+    # Claim the page so concurrent runs (scheduler + /run-processor) don't
+    # double-send, and skip pages whose Notion update hasn't landed yet
+    if not claim_event(page_id):
+        logger.info("↪️ Skipping page %s, already in flight or processed", page_id)
+        return RECORD_IN_FLIGHT
+    email_sent = False
+
+    # Everything after the claim runs under try/finally so the claim is always
+    # released (or marked processed), even if building the invoice raises
+    try:
+        # 6) Generate the XLSX preview in memory
+        invoice_bytes, invoice_name = process_template(fields, page_id, properties)
+        if not invoice_bytes:
+            logger.error("❌ Failed to generate invoice for %s", business_name)
+            return False
+
+        # 7) Send it
+        email_sent = send_email(
+            recipient_email=etsy_email,
+            subject="Your Custom Invoice Template & Brand ID",
+            body=f"Hi {business_name},\n\nYour Brand ID is {brand_id}. See the attached invoice template.",
+            attachments=[(invoice_name, invoice_bytes)],
+            business_name=business_name,
+            brand_id=brand_id
+        )
+
+        # 8) On success, queue the record's single Notion write; only include
+        #    BrandID if the page didn't already have it
+        if email_sent:
+            new_brand_id = brand_id if brand_id != existing_brand_id else None
+            queue_notion_update(page_id, brand_id_properties(new_brand_id, email_sent=True))
+            logger.info("✅ Processed %s (%s)", business_name, page_id)
+
+    except Exception as e:
+        logger.error("❌ Error processing %s (%s): %s", business_name, page_id, e)
+        return False
+
+    finally:
+        if email_sent:
+            mark_event_processed(page_id)
+        else:
+            release_event(page_id)
+
+    return email_sent
+
+
+def read_last_tick():
+    """Return the start time of the last fully successful run, or None"""
+    try:
+        with open(LAST_TICK_PATH) as tick_file:
+            return datetime.fromisoformat(tick_file.read().strip())
+    except (OSError, ValueError):
+        return None
+
+def write_last_tick(tick):
+    """Persist the start time of a fully successful run"""
+    tmp_path = f"{LAST_TICK_PATH}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'w') as tick_file:
+            tick_file.write(tick.isoformat())
+        os.replace(tmp_path, LAST_TICK_PATH)
+    except OSError as e:
+        logger.warning(f"Could not save last tick: {e}")
+
+def query_pending_records(since=None):
+    """Fetch every page still needing a Brand ID or an email, optionally only those edited since a time"""
+    # No BrandID, or Email Sent still False (a page with a BrandID but no email
+    # is covered by the second clause)
+    pending_filter = {
+        "or": [
+            {"property": "BrandID",    "rich_text": {"is_empty": True}},
+            {"property": "Email Sent", "checkbox":  {"equals": False}}
+        ]
+    }
+    if since is not None:
+        pending_filter = {
+            "and": [
+                pending_filter,
+                {"timestamp": "last_edited_time", "last_edited_time": {"on_or_after": since.isoformat()}}
+            ]
+        }
+    
+    results = []
+    cursor = None
+    while True:
+        kwargs = {"database_id": DATABASE_ID, "filter": pending_filter, "page_size": 100}
+        if cursor:
+            kwargs["start_cursor"] = cursor
+        response = notion_query(**kwargs)
+        results.extend(response.get("results", []))
+        if not response.get("has_more"):
+            return results
+        cursor = response.get("next_cursor")
+
 def process_pending_records():
     """
     Scan the Notion database for entries needing a Brand ID or an email send,
@@ -737,102 +1453,35 @@ def process_pending_records():
         return 0
 
     try:
-        # 1) Query for pages with no BrandID OR BrandID present but Email Sent == False
-        results = notion.databases.query(
-            database_id=DATABASE_ID,
-            filter={
-                "or": [
-                    {"property": "BrandID",    "rich_text": {"is_empty": True}},
-                    {"and": [
-                        {"property": "BrandID",    "rich_text": {"is_not_empty": True}},
-                        {"property": "Email Sent", "checkbox":  {"equals": False}}
-                    ]}
-                ]
-            }
-        ).get("results", [])
+        # Expire old claims here too, so expiry doesn't depend on the scheduler's sweep job
+        sweep_processed_events()
+
+        # 1) Query for pages with no BrandID OR BrandID present but Email Sent == False,
+        #    only looking at pages edited since the last clean run
+        run_started = datetime.now(timezone.utc)
+        last_tick = read_last_tick()
+        since = last_tick - timedelta(seconds=LAST_TICK_OVERLAP) if last_tick else None
+        results = query_pending_records(since)
 
         logger.info(f"🗂  Found {len(results)} record(s) to process")
 
-        processed_count = 0
-
-        for record in results:
-            page_id    = record["id"]
-            properties = record.get("properties", {})
-
-            # Dump the actual property keys so you can verify names
-            logger.debug(f"Properties for page {page_id}: {list(properties.keys())}")
-
-            # 2) Extract your fields
-            business_name   = get_property_value(properties, "Company",     "rich_text")
-            etsy_email      = get_property_value(properties, "Etsy Email",  "email")
-            phone           = get_property_value(properties, "Phone",       "phone_number")
-            address         = get_property_value(properties, "Address",     "rich_text")
-            city_state_zip  = get_property_value(properties, "CityStateZip","rich_text")
-            tax_percentage  = get_property_value(properties, "Tax Percentage", "number") or "7"
-
-            # 3) Skip invalid entries
-            if not business_name or not etsy_email:
-                logger.warning(f"Skipping {page_id}: missing Company or Etsy Email")
-                continue
-
-            # 4) Brand ID: reuse if present, else generate with the Etsy email
-            existing_brand_id = get_property_value(properties, "BrandID", "rich_text")
-            if existing_brand_id:
-                brand_id = existing_brand_id
-                logger.info(f"↪️ Using existing Brand ID {brand_id} for {business_name}")
-            else:
-                brand_id = generate_brand_id(business_name, etsy_email)
-                logger.info(f"✨ Generated Brand ID {brand_id} for {business_name}")
-
-            # 5) Build a minimal fields dict for your template step
-            fields = {
-                "Company Name": business_name,
-                "Address":      address,
-                "City, State ZIP": city_state_zip,
-                "Phone":        phone,
-                "Email":        etsy_email,
-                "Tax %":        str(tax_percentage),
-                "Currency":     "USD",
-            }
-
-            # 6) Generate the XLSX preview
-            invoice_path, temp_files = process_template(fields, page_id)
+        # Each record is dominated by Notion/HTTP/SMTP waits, so overlap them
+        with ThreadPoolExecutor(max_workers=RECORD_WORKERS) as executor:
+            outcomes = list(executor.map(_process_record, results))
+        processed_count = outcomes.count(True)
 
-            try:
-                if not invoice_path:
-                    logger.error(f"❌ Failed to generate invoice for {business_name}")
-                    continue
-
-                # 7) Send it
-                email_sent = send_email(
-                    recipient_email=etsy_email,
-                    subject="Your Custom Invoice Template & Brand ID",
-                    body=f"Hi {business_name},\n\nYour Brand ID is {brand_id}. See the attached invoice template.",
-                    attachment_paths=[invoice_path],
-                    business_name=business_name,
-                    brand_id=brand_id
-                )
-
-                # 8) On success, update Notion
-                if email_sent:
-                    notion.pages.update(
-                        page_id=page_id,
-                        properties={
-                            "BrandID":   {"rich_text": [{"text": {"content": brand_id}}]},
-                            "Email Sent":{"checkbox":  True}
-                        }
-                    )
-                    processed_count += 1
-                    logger.info(f"✅ Processed {business_name} ({page_id})")
-
-            finally:
-                # 9) Clean up
-                for fp in temp_files:
-                    try:    os.unlink(fp)
-                    except: pass
-
-            # 10) Rate-limit
-            time.sleep(1)
+        # Send this run's Notion writes, then check that every one of them landed;
+        # the periodic flush job may have sent (or failed) some of them already
+        flush_notion_updates()
+        sent_pages = [record["id"] for record, outcome in zip(results, outcomes) if outcome is True]
+        unconfirmed = unconfirmed_notion_updates(sent_pages)
+        if unconfirmed:
+            logger.warning(f"⚠️ {len(unconfirmed)} Notion update(s) from this run haven't landed yet")
+
+        # Only move the window forward if nothing failed, no page was left to
+        # another run and all writes landed, so those pages are still in the window next tick
+        if False not in outcomes and RECORD_IN_FLIGHT not in outcomes and not unconfirmed:
+            write_last_tick(run_started)
 
         logger.info(f"🎯 Finished: {processed_count}/{len(results)} records processed")
         return processed_count
@@ -841,6 +1490,22 @@ def process_pending_records():
         logger.error(f"⚠️ Error querying Notion database: {e}")
         return 0
 
+    finally:
+        # Make sure nothing is left waiting in the queue if the run aborted
+        flush_notion_updates()
+        # The batch is done; don't hold the SMTP session open until the next tick
+        SMTP_POOL.close()
+
+
+def start_manual_run():
+    """Run process_pending_records in the background; returns False if a run is already pending"""
+    global _manual_run
+    with _MANUAL_RUN_LOCK:
+        if _manual_run is not None and not _manual_run.done():
+            return False
+        _manual_run = RUN_EXECUTOR.submit(process_pending_records)
+        return True
+
 
 # === SCHEDULER ===
 def start_scheduler():
@@ -852,6 +1517,30 @@ def start_scheduler():
         minutes=SCHEDULER_INTERVAL,
         id='process_pending_records_job'
     )
+    scheduler.add_job(
+        flush_notion_updates,
+        'interval',
+        seconds=NOTION_FLUSH_INTERVAL,
+        id='flush_notion_updates_job'
+    )
+    scheduler.add_job(
+        sweep_processed_events,
+        'interval',
+        minutes=EVENT_SWEEP_INTERVAL,
+        id='sweep_processed_events_job'
+    )
+    scheduler.add_job(
+        sweep_notion_cache,
+        'interval',
+        minutes=EVENT_SWEEP_INTERVAL,
+        id='sweep_notion_cache_job'
+    )
+    scheduler.add_job(
+        sweep_logo_cache,
+        'interval',
+        minutes=LOGO_CACHE_SWEEP_INTERVAL,
+        id='sweep_logo_cache_job'
+    )
     scheduler.start()
     logger.info(f"Scheduler started, will run every {SCHEDULER_INTERVAL} minutes")
     return scheduler
@@ -860,10 +1549,11 @@ def start_scheduler():
 @app.route("/health", methods=["GET"])
 def health_check():
     """Simple health check endpoint"""
+    events = snapshot_processed_events()
     return jsonify({
         "status": "ok",
-        "processed_events": len(PROCESSED_EVENTS),
-        "processed_details": {k: v.get("processed", False) for k, v in PROCESSED_EVENTS.items()},
+        "processed_events": count_processed_events(),
+        "processed_details": {k: processed for k, (_, processed) in events.items()},
         "timestamp": datetime.now().isoformat()
     })
 
@@ -886,13 +1576,13 @@ def etsyinfo():
 
 @app.route("/run-processor", methods=["POST"])
 def manual_run():
-    """Endpoint to manually trigger the processing job"""
+    """Endpoint to manually trigger the processing job; the run happens in the background"""
     try:
-        process_pending_records()
+        started = start_manual_run()
         return jsonify({
-            "status": "success",
+            "status": "accepted" if started else "already_running",
             "timestamp": datetime.now().isoformat()
-        })
+        }), 202
     except Exception as e:
         logger.error(f"Error in manual run: {e}")
         return jsonify({
@@ -915,8 +1605,10 @@ if __name__ == "__main__":
     # Run once at startup
     process_pending_records()
     
-    # Start the Flask app
+    # Start the Flask app (local development only; production runs under
+    # gunicorn, where gunicorn.conf.py starts the scheduler in one worker).
+    # No debug reloader, which would start a second scheduler in the child process
     try:
-        app.run(debug=True)
+        app.run(threaded=True)
     except (KeyboardInterrupt, SystemExit):
         scheduler.shutdown()
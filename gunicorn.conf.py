@@ -0,0 +1,43 @@
+# Gunicorn settings, picked up automatically by `gunicorn app:app`.
+# Binds to $PORT when it is set (Render), otherwise 127.0.0.1:8000.
+import fcntl
+import os
+
+# app is a WSGI Flask app, so use threaded sync workers rather than an ASGI worker class.
+# The Notion rate limiter (3 req/s) lives in each process, so every extra worker adds
+# another 3 req/s against Notion's shared limit; keep one worker and let threads absorb
+# concurrent requests
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+
+# Logo downloads and SMTP sends can be slow; don't let the arbiter kill a busy worker
+timeout = 120
+graceful_timeout = 30
+keepalive = 5
+
+# Don't preload: pools and locks created at import must not be shared across forks
+preload_app = False
+
+# The scheduler (record processing, Notion flushes, cache sweeps) must run in exactly
+# one worker. The first worker to take this lock starts it and holds the lock until it
+# exits, at which point its replacement takes over. lockf (POSIX record lock) rather
+# than flock: record locks belong to the process and are not inherited across fork,
+# so nothing the worker spawns can keep holding it after the worker dies
+SCHEDULER_LOCK_PATH = os.getenv("SCHEDULER_LOCK_PATH", "/tmp/brandid-scheduler.lock")
+_scheduler_lock = None
+
+def post_worker_init(worker):
+    """Start the background scheduler in the worker that wins the scheduler lock"""
+    global _scheduler_lock
+    lock_file = open(SCHEDULER_LOCK_PATH, "w")
+    try:
+        fcntl.lockf(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return
+    _scheduler_lock = lock_file
+
+    from app import start_scheduler
+    start_scheduler()
+    worker.log.info("Scheduler started in worker %s", worker.pid)